@@ -1,117 +1,423 @@
+# Heavy dependencies (psycopg2, graphviz, google.generativeai and its
+# grpc/protobuf tree) are imported lazily inside the functions that
+# need them, so an unauthenticated visitor's first paint doesn't pay
+# their import cost.
 import streamlit as st
-import psycopg2
-import graphviz
+import streamlit.components.v1 as components
 import os
+import re
 import time
 import json
+import threading
+import concurrent.futures
 import hashlib
-import google.generativeai as genai
+import hmac
+import bcrypt
+from contextlib import contextmanager
+
+try:
+    import orjson
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj)
 
 # ============================
 # Gemini Config
 # ============================
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-genai.configure(api_key=GOOGLE_API_KEY)
 
 # Using gemini-1.5-flash for speed and efficiency
 MODEL_NAME = "gemini-3-flash-preview"
 
+SYSTEM_INSTRUCTION = (
+    "You are a senior database architect. "
+    "Convert the user's description into a VALID Graphviz DOT string "
+    "for an ER diagram. "
+    "Use box shapes for entities. "
+    "No markdown. No explanations. "
+    "Return ONLY raw DOT code."
+)
+
+# The model must be rebuilt before its server-side CachedContent
+# expires, or every call afterwards fails with "CachedContent not
+# found" until restart — so cache_resource's ttl stays below it.
+_CACHED_CONTENT_TTL_S = 3600
+_MODEL_TTL_S = 3000
+
+@st.cache_resource(ttl=_MODEL_TTL_S, show_spinner=False)
+def get_model():
+    # Cache the stable system instruction server-side so each call only
+    # sends the user prompt. Falls back to inlining it when caching is
+    # unavailable (e.g. instruction below the provider's minimum token
+    # threshold).
+    import google.generativeai as genai
+    genai.configure(api_key=GOOGLE_API_KEY)
+    try:
+        cached = genai.caching.CachedContent.create(
+            model=MODEL_NAME,
+            system_instruction=SYSTEM_INSTRUCTION,
+            ttl=f"{_CACHED_CONTENT_TTL_S}s",
+        )
+        return genai.GenerativeModel.from_cached_content(cached_content=cached)
+    except Exception:
+        return genai.GenerativeModel(
+            model_name=MODEL_NAME,
+            system_instruction=SYSTEM_INSTRUCTION
+        )
+
 # ============================
-# Database Connection
+# Database Connection (pooled)
 # ============================
+@st.cache_resource(show_spinner=False)
+def get_pool():
+    import psycopg2.pool
+    return psycopg2.pool.ThreadedConnectionPool(
+        minconn=1,
+        maxconn=10,
+        host=os.getenv("DB_HOST", "localhost"),
+        database=os.getenv("DB_NAME", "erd_database"),
+        user=os.getenv("DB_USER", "user"),
+        password=os.getenv("DB_PASS", "password"),
+        connect_timeout=5
+    )
+
+# Statements prepared once per physical connection so the server skips
+# parse/plan on every execution. Tracked by backend PID because pooled
+# connections outlive a single borrow.
+PREPARED_STATEMENTS = (
+    "PREPARE auth_select(text) AS "
+    "SELECT id, password_hash FROM users WHERE email = $1",
+    "PREPARE log_ins(text, jsonb, float8, int) AS "
+    "INSERT INTO logs (project_id, user_prompt, llm_response, execution_time) "
+    "SELECT id, $1, $2, $3 FROM projects "
+    "WHERE user_id = $4 AND is_default LIMIT 1",
+)
+
+@st.cache_resource(show_spinner=False)
+def _get_prepared_pids():
+    # Must live in cache_resource beside the pool: the pool (and its
+    # already-prepared connections) survives full script reruns, while
+    # module globals are rebuilt empty each run and would trigger
+    # duplicate PREPAREs.
+    return set()
+
+def _ensure_prepared(conn):
+    prepared = _get_prepared_pids()
+    pid = conn.info.backend_pid
+    if pid in prepared:
+        return
+    with conn.cursor() as cur:
+        for stmt in PREPARED_STATEMENTS:
+            cur.execute(stmt)
+    conn.commit()
+    prepared.add(pid)
+
 def get_connection():
+    conn = None
     try:
-        return psycopg2.connect(
-            host=os.getenv("DB_HOST", "localhost"),
-            database=os.getenv("DB_NAME", "erd_database"),
-            user=os.getenv("DB_USER", "user"),
-            password=os.getenv("DB_PASS", "password"),
-            connect_timeout=5
-        )
+        pool = get_pool()
+        # Pooled connections can die server-side while idle (Postgres
+        # restart, idle timeout); validate cheaply on borrow and
+        # replace dead ones instead of handing them to callers.
+        for _ in range(3):
+            conn = pool.getconn()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+                break
+            except Exception:
+                _get_prepared_pids().discard(conn.info.backend_pid)
+                pool.putconn(conn, close=True)
+                conn = None
+        if conn is None:
+            raise Exception("no live database connection available")
+        _ensure_prepared(conn)
+        return conn
     except Exception as e:
+        if conn is not None:
+            get_pool().putconn(conn, close=True)
         st.error(f"DB Error: {e}")
         return None
 
+def release_connection(conn):
+    # Keep the TCP/TLS session warm. Plain reads leave psycopg2
+    # idle-in-transaction (it opens a transaction on any statement), so
+    # roll those back and return the connection; only discard
+    # connections that are actually broken.
+    import psycopg2.extensions
+    pool = get_pool()
+    if conn.closed:
+        pool.putconn(conn, close=True)
+        return
+    if conn.status != psycopg2.extensions.STATUS_READY:
+        try:
+            conn.rollback()
+        except Exception:
+            _get_prepared_pids().discard(conn.info.backend_pid)
+            pool.putconn(conn, close=True)
+            return
+    pool.putconn(conn)
+
+@contextmanager
+def db_connection():
+    conn = get_connection()
+    try:
+        yield conn
+    finally:
+        if conn:
+            release_connection(conn)
+
+# ============================
+# Log Buffer
+# ============================
+LOG_FLUSH_THRESHOLD = 5
+
+LOG_INSERT_SQL = "EXECUTE log_ins(%s, %s, %s, %s)"
+
+def flush_pending_logs():
+    import psycopg2.extras
+    rows = st.session_state.get("pending_logs") or []
+    if not rows:
+        return
+    with db_connection() as conn:
+        if not conn:
+            return
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_batch(cur, LOG_INSERT_SQL, rows, page_size=100)
+            conn.commit()
+    st.session_state.pending_logs = []
+
 # ============================
 # Auth Helpers
 # ============================
 def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(12)).decode()
+
+def verify_password(password: str, stored_hash: str) -> bool:
+    # bcrypt.checkpw is already constant-time; the legacy SHA-256 path
+    # uses hmac.compare_digest so neither branch leaks timing
+    if stored_hash.startswith("$2"):
+        return bcrypt.checkpw(password.encode(), stored_hash.encode())
+    # Legacy accounts created before the bcrypt migration
+    return hmac.compare_digest(
+        stored_hash.encode(),
+        hashlib.sha256(password.encode()).hexdigest().encode()
+    )
 
 def authenticate_user(email, password):
-    conn = get_connection()
-    if not conn:
-        return None
-    with conn.cursor() as cur:
-        cur.execute("SELECT id, password_hash FROM users WHERE email = %s", (email,))
-        row = cur.fetchone()
-    conn.close()
-    if row and row[1] == hash_password(password):
+    with db_connection() as conn:
+        if not conn:
+            return None
+        with conn.cursor() as cur:
+            cur.execute("EXECUTE auth_select(%s)", (email,))
+            row = cur.fetchone()
+    if row and verify_password(password, row[1]):
         return row[0]
     return None
 
 def create_user(email, password):
-    conn = get_connection()
-    if not conn:
-        return False
-    try:
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                # Single round-trip: create the user and their default
+                # project in one statement
+                cur.execute(
+                    """
+                    WITH new_user AS (
+                        INSERT INTO users (email, password_hash)
+                        VALUES (%s, %s)
+                        RETURNING id
+                    )
+                    INSERT INTO projects (user_id, name, description, is_default)
+                    SELECT id, %s, %s, TRUE FROM new_user
+                    RETURNING user_id
+                    """,
+                    (email, hash_password(password),
+                     "My First ERD Project", "Default workspace")
+                )
+                cur.fetchone()
+                conn.commit()
+            return True
+        except Exception as e:
+            print(e)
+            conn.rollback()
+            return False
+
+# ============================
+# Gemini Caller (Cached)
+# ============================
+# Extracts the fenced block in one pass; also tolerates a lone fence,
+# which crashed the old split("```")[1] cleanup
+_FENCE_RE = re.compile(r"```(?:dot|graphviz)?\s*(.*?)```", re.S)
+
+# Prompts that reference mutable or prior state ("add a column to the
+# table I described yesterday") would be served stale results from the
+# caches, so only informational describe-this-schema prompts are cached.
+_COMMAND_RE = re.compile(
+    r"\b(update|add|remove|alter|delete|change|modify|prev(?:ious)?|last time|yesterday)\b",
+    re.I,
+)
+
+def _is_informational(prompt_text):
+    return not _COMMAND_RE.search(prompt_text)
+
+def _llm_cache_key(prompt_text):
+    raw = f"{MODEL_NAME}|{SYSTEM_INSTRUCTION}|{prompt_text}|0.2"
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+def _llm_cache_get(key):
+    with db_connection() as conn:
+        if not conn:
+            return None
+        with conn.cursor() as cur:
+            cur.execute("SELECT dot, duration FROM llm_cache WHERE key = %s", (key,))
+            return cur.fetchone()
+
+def _llm_cache_put(key, dot, duration):
+    with db_connection() as conn:
+        if not conn:
+            return
         with conn.cursor() as cur:
             cur.execute(
-                "INSERT INTO users (email, password_hash) VALUES (%s, %s) RETURNING id",
-                (email, hash_password(password))
-            )
-            user_id = cur.fetchone()[0]
-            cur.execute(
-                "INSERT INTO projects (user_id, name, description) VALUES (%s, %s, %s)",
-                (user_id, "My First ERD Project", "Default workspace")
+                "INSERT INTO llm_cache (key, dot, duration) VALUES (%s, %s, %s) "
+                "ON CONFLICT (key) DO NOTHING",
+                (key, dot, duration)
             )
             conn.commit()
-        return True
-    except Exception as e:
-        print(e)
-        return False
-    finally:
-        conn.close()
 
-# ============================
-# Gemini Caller (Cached)
-# ============================
+# Coalesces concurrent identical prompts across sessions: st.cache_data
+# only stores a result at completion, so a second user submitting the
+# same prompt mid-flight would start a duplicate Gemini call. The leader
+# runs the call; followers wait on its Future. The map and lock must be
+# process-wide via cache_resource — module globals are per-run and would
+# never be shared between sessions.
+@st.cache_resource(show_spinner=False)
+def _get_inflight():
+    return {}, threading.Lock()
+
 @st.cache_data(ttl=3600, show_spinner=False)
-def call_gemini_for_dot(prompt_text):
-    system_instruction = (
-        "You are a senior database architect. "
-        "Convert the user's description into a VALID Graphviz DOT string "
-        "for an ER diagram. "
-        "Use box shapes for entities. "
-        "No markdown. No explanations. "
-        "Return ONLY raw DOT code."
-    )
+def call_gemini_for_dot(prompt_text, _placeholder=None):
+    # Persistent cache survives Streamlit restarts, unlike st.cache_data
+    key = _llm_cache_key(prompt_text)
+    try:
+        hit = _llm_cache_get(key)
+    except Exception:
+        hit = None
+    if hit:
+        return hit[0], hit[1]
 
-    model = genai.GenerativeModel(
-        model_name=MODEL_NAME,
-        system_instruction=system_instruction
-    )
+    inflight, inflight_lock = _get_inflight()
+    with inflight_lock:
+        future = inflight.get(key)
+        leader = future is None
+        if leader:
+            future = concurrent.futures.Future()
+            inflight[key] = future
+    if not leader:
+        return future.result()
+
+    try:
+        result = _generate_dot(prompt_text, key, _placeholder)
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with inflight_lock:
+            inflight.pop(key, None)
+
+def _generate_dot(prompt_text, key, _placeholder=None):
+    import google.generativeai as genai
+    model = get_model()
 
     start = time.time()
+    # Stream so the user sees DOT as it is generated instead of a
+    # spinner until the full response lands
     response = model.generate_content(
         prompt_text,
         generation_config=genai.types.GenerationConfig(
             temperature=0.2,
-        )
+        ),
+        stream=True
     )
+    parts = []
+    for chunk in response:
+        if chunk.text:
+            parts.append(chunk.text)
+            if _placeholder is not None:
+                _placeholder.code("".join(parts), language="dot")
     duration = time.time() - start
 
-    if not response.text:
+    if _placeholder is not None:
+        _placeholder.empty()
+
+    if not parts:
         raise Exception("Gemini returned an empty response.")
 
-    content = response.text.strip()
-    
+    content = "".join(parts).strip()
+
     if "```" in content:
-        content = content.split("```")[1]
-        if content.startswith("dot"):
-            content = content[3:]
-    
-    return content.strip(), duration
+        m = _FENCE_RE.search(content)
+        if m:
+            content = m.group(1)
+
+    content = content.strip()
+    if key is not None:
+        try:
+            _llm_cache_put(key, content, duration)
+        except Exception:
+            pass
+    return content, duration
+
+# ============================
+# Diagram Rendering
+# ============================
+# Client-side rendering needs the jsdelivr CDN; set ERD_WASM_RENDER=0
+# for offline deployments to use the server-side Graphviz renderer.
+WASM_RENDER = os.getenv("ERD_WASM_RENDER", "1") != "0"
+
+def render_dot_wasm(dot_src, height=500):
+    # Lay out the graph in the browser with Graphviz compiled to WASM
+    # instead of invoking the Graphviz binary on the server. Layout cost
+    # moves to each client and no longer serializes behind one process.
+    # Failures (CDN load, WASM init, invalid DOT) happen in the browser
+    # and never reach Python, so the error is rendered into the panel
+    # by the script itself. json.dumps doesn't escape "/", so "</"
+    # must be escaped or a user-edited DOT containing </script> would
+    # terminate the inline script element.
+    dot_js = json.dumps(dot_src).replace("</", "<\\/")
+    components.html(
+        f"""
+        <div id="graph" style="overflow:auto"></div>
+        <script type="module">
+            const el = document.getElementById("graph");
+            try {{
+                const {{ Graphviz }} = await import("https://cdn.jsdelivr.net/npm/@hpcc-js/wasm@2/dist/graphviz.js");
+                const graphviz = await Graphviz.load();
+                el.innerHTML = graphviz.layout({dot_js}, "svg", "dot");
+            }} catch (err) {{
+                el.style.color = "crimson";
+                el.textContent = "Graphviz rendering error: " +
+                    (err && err.message ? err.message : err);
+            }}
+        </script>
+        """,
+        height=height,
+        scrolling=True,
+    )
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def render_svg(dot_src: str) -> bytes:
+    # Backs the SVG download button; keyed by the DOT source so
+    # re-exporting an unchanged diagram skips Graphviz layout
+    import graphviz
+    return graphviz.Source(dot_src).pipe(format="svg")
 
 # ============================
 # UI Setup
@@ -119,20 +425,36 @@ def call_gemini_for_dot(prompt_text):
 st.set_page_config(page_title="AutoERGen Gemini v1", layout="wide")
 for key in ["logged_in", "user_id", "last_dot"]:
     st.session_state.setdefault(key, None)
+st.session_state.setdefault("pending_logs", [])
 
 # ============================
 # Sidebar (Login / Signup)
 # ============================
-with st.sidebar:
+# Fragments rerun in isolation, so typing in a form no longer reruns
+# the whole script. Auth changes affect the main panel, so those
+# rerun the full app explicitly. The sidebar container must be entered
+# inside the fragment: fragments called from within a container's
+# `with` block redraw to the main body on fragment reruns.
+@st.fragment
+def auth_sidebar():
+    with st.sidebar:
+        _auth_sidebar_contents()
+
+def _auth_sidebar_contents():
     st.title("🛡️ AutoERGen (Gemini Edition)")
 
     if st.session_state.logged_in:
         st.success("Logged in")
         if st.button("Logout"):
+            try:
+                flush_pending_logs()
+            except Exception as e:
+                # Rows stay buffered on failure; logout proceeds anyway
+                st.warning(f"Could not flush pending logs: {e}")
             st.session_state.logged_in = False
             st.session_state.user_id = None
             st.session_state.last_dot = None
-            st.rerun() 
+            st.rerun(scope="app")
 
     else:
         tab1, tab2 = st.tabs(["🔐 Login", "📝 Sign Up"])
@@ -146,7 +468,7 @@ with st.sidebar:
                     if uid:
                         st.session_state.logged_in = True
                         st.session_state.user_id = uid
-                        st.rerun()
+                        st.rerun(scope="app")
                     else:
                         st.error("Invalid credentials")
 
@@ -161,36 +483,33 @@ with st.sidebar:
                     else:
                         st.error("Email already exists")
 
+auth_sidebar()
+
 # ============================
 # Main App
 # ============================
-if st.session_state.logged_in:
+@st.fragment
+def generator_panel():
     st.header("Group 4: ER Diagram Generator")
     user_input = st.text_area("Describe your tables and relationships:", height=150)
 
     if st.button("🚀 Generate Diagram") and user_input.strip():
         with st.spinner("Gemini is designing your ER diagram..."):
             try:
-                dot, exec_time = call_gemini_for_dot(user_input)
+                placeholder = st.empty()
+                if _is_informational(user_input):
+                    dot, exec_time = call_gemini_for_dot(user_input, placeholder)
+                else:
+                    # COMMAND-like prompts bypass every cache layer
+                    dot, exec_time = _generate_dot(user_input, None, placeholder)
                 st.session_state.last_dot = dot
 
-                # Log to DB
-                conn = get_connection()
-                if conn:
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            """
-                            INSERT INTO logs (project_id, user_prompt, llm_response, execution_time)
-                            SELECT id, %s, %s, %s
-                            FROM projects
-                            WHERE user_id = %s
-                            ORDER BY created_at
-                            LIMIT 1
-                            """,
-                            (user_input, json.dumps(dot), exec_time, st.session_state.user_id)
-                        )
-                        conn.commit()
-                    conn.close()
+                # Buffer the log row; flushed in batches to save round-trips
+                st.session_state.pending_logs.append(
+                    (user_input, json_dumps(dot), exec_time, st.session_state.user_id)
+                )
+                if len(st.session_state.pending_logs) >= LOG_FLUSH_THRESHOLD:
+                    flush_pending_logs()
             except Exception as e:
                 st.error(f"Error calling Gemini: {e}")
 
@@ -203,10 +522,25 @@ if st.session_state.logged_in:
                 st.session_state.last_dot = edited
         with col2:
             st.subheader("Visual ERD")
+            if WASM_RENDER:
+                render_dot_wasm(st.session_state.last_dot)
+            else:
+                try:
+                    st.graphviz_chart(st.session_state.last_dot)
+                except Exception as e:
+                    st.error(f"Graphviz rendering error: {e}")
             try:
-                st.graphviz_chart(st.session_state.last_dot)
+                st.download_button(
+                    "⬇️ Download SVG",
+                    render_svg(st.session_state.last_dot),
+                    file_name="er_diagram.svg",
+                    mime="image/svg+xml",
+                )
             except Exception as e:
-                st.error(f"Graphviz rendering error: {e}")
+                st.caption(f"SVG export unavailable: {e}")
+
+if st.session_state.logged_in:
+    generator_panel()
 else:
     st.title("Welcome to AutoERGen")
     st.write("Please log in to continue.")
\ No newline at end of file
@@ -11,10 +11,14 @@ CREATE TABLE PROJECTS (
     user_id INT REFERENCES USERS(id) ON DELETE CASCADE,
     name VARCHAR(255) NOT NULL,
     description TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, 
+    is_default BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- One default project per user; index-backed lookup for the logs INSERT
+CREATE UNIQUE INDEX projects_default ON PROJECTS(user_id) WHERE is_default;
+
 CREATE TABLE LOGS (
     id SERIAL PRIMARY KEY,
     project_id INT REFERENCES PROJECTS(id) ON DELETE CASCADE,
@@ -24,6 +28,13 @@ CREATE TABLE LOGS (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP 
 );
 
+CREATE TABLE LLM_CACHE (
+    key TEXT PRIMARY KEY,
+    dot TEXT,
+    duration FLOAT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 CREATE TABLE SAVED_SCHEMAS (
     id SERIAL PRIMARY KEY,
     project_id INT REFERENCES PROJECTS(id) ON DELETE CASCADE,
@@ -35,4 +46,4 @@ CREATE TABLE SAVED_SCHEMAS (
 
 -- Seed Data
 INSERT INTO USERS (email, password_hash) VALUES ('admin@example.com', 'hash_123');
-INSERT INTO PROJECTS (user_id, name, description) VALUES (1, 'My First ERD Project', 'Default workspace');
\ No newline at end of file
+INSERT INTO PROJECTS (user_id, name, description, is_default) VALUES (1, 'My First ERD Project', 'Default workspace', TRUE);
\ No newline at end of file